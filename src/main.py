@@ -15,15 +15,30 @@ Kịch bản hoạt động:
 5. Mô phỏng kết thúc khi hết thời gian hoặc không còn xe.
 """
 
-import traci
 import yaml
 import threading
 import time
 import os
 import sys
 import logging
-from multiprocessing import Manager
-from typing import Dict, Any, List
+import math
+import numpy as np
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+# Dùng trình phân tích YAML viết bằng C (libyaml) nếu có, nếu không dùng bản Python
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
+
+# Đặt biến môi trường USE_LIBSUMO=1 để dùng libsumo (gọi trực tiếp trong tiến trình,
+# không qua socket TCP). Mặc định vẫn dùng TraCI để thuận tiện cho việc gỡ lỗi.
+if os.environ.get('USE_LIBSUMO', '0') == '1':
+    import libsumo as traci
+else:
+    import traci
+tc = traci.constants
 
 # Import các thành phần cần thiết từ các module khác trong dự án
 from sumosim import SumoSim
@@ -38,13 +53,24 @@ from algorithm.algo import (
 )
 from visualizer import RealTimePlotter
 
+# Các đường dẫn của dự án, tính một lần khi nạp module
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+CONFIG_DIR = PROJECT_ROOT / 'src' / 'config'
+OUTPUT_DIR = PROJECT_ROOT / 'output'
+
 # --- CẤU HÌNH LOGGING ---
 # Thiết lập hệ thống ghi log để theo dõi hoạt động của chương trình.
+# Mức log có thể đổi bằng biến môi trường LOG_LEVEL (vd: LOG_LEVEL=WARNING khi đo hiệu năng).
+# Giá trị không hợp lệ thì dùng INFO và cảnh báo, thay vì để basicConfig báo lỗi khi khởi động.
+_log_level_name = os.environ.get('LOG_LEVEL', 'INFO').upper()
+_log_level = logging.getLevelName(_log_level_name)
 logging.basicConfig(
-    level=logging.INFO,
+    level=_log_level if isinstance(_log_level, int) else logging.INFO,
     format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
+if not isinstance(_log_level, int):
+    logging.warning("LOG_LEVEL=%s không hợp lệ, dùng mức INFO.", _log_level_name)
 
 # =============================================================================
 # CÁC HÀM TẢI CẤU HÌNH
@@ -66,7 +92,7 @@ def load_yaml_config(config_path: str) -> Dict[str, Any]:
     if not os.path.exists(config_path):
         raise FileNotFoundError(f"File cấu hình không tồn tại: {config_path}")
     with open(config_path, "r", encoding='utf-8') as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=YamlSafeLoader)
         if config is not None:
             return config
         else:
@@ -76,85 +102,169 @@ def load_yaml_config(config_path: str) -> Dict[str, Any]:
 # LUỒNG ĐIỀU KHIỂN ĐÈN GIAO THÔNG
 # =============================================================================
 
-def update_traffic_light_logic(tl_id: str, new_times: Dict[str, Any], phase_info: Dict[str, Any]):
+# Cache logic đèn (kết quả getCompleteRedYellowGreenDefinition) theo tl_id. Cấu trúc pha
+# trong SUMO không đổi trong suốt mô phỏng nên chỉ cần lấy một lần, sau đó sửa trực tiếp
+# thời gian của các pha trên đối tượng đã cache.
+_tls_logic_cache: Dict[str, Any] = {}
+
+# Chỉ số các pha chính và pha phụ của từng giao lộ, tính sẵn một lần khi khởi tạo
+# Định dạng: { "intersection_id": (main_indices, secondary_indices) }
+_phase_index_cache: Dict[str, Tuple[Tuple[int, ...], Tuple[int, ...]]] = {}
+
+def build_phase_index_cache(config_manager: IntersectionConfigManager):
+    """
+    Đọc phase_info của các giao lộ một lần và lưu sẵn chỉ số pha chính và pha phụ
+    (mỗi pha phụ lấy chỉ số đầu tiên) dưới dạng tuple.
+    """
+    for int_id in config_manager.get_intersection_ids():
+        phase_info = config_manager.get_phase_info(int_id)
+        if not phase_info:
+            continue
+        main_indices = tuple(phase_info.get('p', {}).get('phase_indices', []))
+        secondary_indices = tuple(s_phase['phase_indices'][0] for s_phase in phase_info.get('s', []) if s_phase.get('phase_indices'))
+        _phase_index_cache[int_id] = (main_indices, secondary_indices)
+
+def update_traffic_light_logic(tl_id: str, new_times: Dict[str, Any], main_indices: Tuple[int, ...], secondary_indices: Tuple[int, ...]):
     """
     Cập nhật logic (thời gian xanh) cho một đèn giao thông cụ thể.
 
     Args:
         tl_id: ID của đèn giao thông trong SUMO.
         new_times: Dictionary chứa thời gian xanh mới cho pha chính ('p') và các pha phụ ('s').
-        phase_info: Thông tin về các chỉ số pha chính và phụ.
+        main_indices: Chỉ số các pha chính trong logic đèn.
+        secondary_indices: Chỉ số pha của từng pha phụ, theo thứ tự của new_times['s'].
     """
     try:
-        # Lấy định nghĩa đầy đủ của đèn (bao gồm các pha)
-        logic = traci.trafficlight.getCompleteRedYellowGreenDefinition(tl_id)[0]
+        # Lấy định nghĩa đầy đủ của đèn (bao gồm các pha), chỉ gọi Traci ở lần đầu tiên
+        logic = _tls_logic_cache.get(tl_id)
+        if logic is None:
+            logic = traci.trafficlight.getCompleteRedYellowGreenDefinition(tl_id)[0]
+            _tls_logic_cache[tl_id] = logic
+        phases = logic.phases
+        num_phases = len(phases)
 
         # Cập nhật thời gian xanh cho các pha chính
-        main_phases = phase_info.get('p', {}).get('phase_indices', [])
-        for phase_index in main_phases:
-            if 0 <= phase_index < len(logic.phases):
-                logic.phases[phase_index].duration = new_times['p']
+        for phase_index in main_indices:
+            if 0 <= phase_index < num_phases:
+                phases[phase_index].duration = new_times['p']
 
         # Cập nhật thời gian xanh cho các pha phụ
-        secondary_phases = [s_phase['phase_indices'][0] for s_phase in phase_info.get('s', []) if s_phase.get('phase_indices')]
-        for i, phase_index in enumerate(secondary_phases):
-            if 0 <= phase_index < len(logic.phases) and i < len(new_times['s']):
-                logic.phases[phase_index].duration = new_times['s'][i]
+        secondary_times = new_times['s']
+        for i, phase_index in enumerate(secondary_indices):
+            if 0 <= phase_index < num_phases and i < len(secondary_times):
+                phases[phase_index].duration = secondary_times[i]
         
         # Áp dụng logic mới vào mô phỏng
         traci.trafficlight.setCompleteRedYellowGreenDefinition(tl_id, logic)
 
     except traci.TraCIException as e:
-        logging.error(f"Lỗi Traci khi cập nhật TLS {tl_id}: {e}")
+        logging.error("Lỗi Traci khi cập nhật TLS %s: %s", tl_id, e)
+
+# Chỉ mục các chương trình đèn, lấy một lần khi khởi tạo
+# Định dạng: { "tl_id": { "programID": logic } }
+_program_index: Dict[str, Dict[str, Any]] = {}
+
+def build_program_index(tl_ids: List[str]):
+    """
+    Lấy tất cả chương trình của các đèn giao thông một lần và lập chỉ mục theo programID,
+    để vòng lặp chính không phải gọi getAllProgramLogics và tìm kiếm tuyến tính mỗi bước.
+    """
+    for tl_id in tl_ids:
+        try:
+            _program_index[tl_id] = {p.programID: p for p in traci.trafficlight.getAllProgramLogics(tl_id)}
+        except traci.TraCIException as e:
+            logging.warning("Không thể lấy chương trình đèn của %s: %s", tl_id, e)
 
 # Dictionary để lưu các kế hoạch đèn đang chờ được áp dụng
 # Định dạng: { "intersection_id": new_green_times_for_that_intersection }
 pending_logic_updates = {}
 
-def prepare_logic_update(shared_dict: Dict):
+# Thời điểm sớm nhất cần kiểm tra lại từng giao lộ đang chờ (một bước trước lần chuyển pha kế tiếp)
+# Định dạng: { "intersection_id": sim_time }
+_eligible_at: Dict[str, float] = {}
+# Thời điểm kiểm tra sớm nhất trong _eligible_at. Vòng lặp chính chỉ gọi
+# apply_pending_updates_on_cycle_start khi đã đến thời điểm này.
+next_eligible_time = math.inf
+# Sai số cho phép khi so sánh thời gian mô phỏng dạng số thực
+_TIME_EPSILON = 1e-6
+
+def _schedule_check(int_id: str, next_switch: float, sim_step: float):
+    """Hẹn kiểm tra lại giao lộ vào bước mô phỏng ngay trước lần chuyển pha kế tiếp."""
+    _eligible_at[int_id] = next_switch - sim_step - _TIME_EPSILON
+
+def _update_next_eligible_time():
+    """Tính lại thời điểm kiểm tra sớm nhất sau khi thêm/xóa giao lộ đang chờ."""
+    global next_eligible_time
+    next_eligible_time = min(_eligible_at.values(), default=math.inf)
+
+def prepare_logic_update(shared_dict: Dict, tl_id_by_int: Dict[str, str], sim_step: float):
     """
     Lấy dữ liệu thời gian xanh mới từ shared_dict và lưu vào danh sách chờ
     'pending_logic_updates' để được áp dụng vào chu kỳ đèn tiếp theo.
+    tl_id_by_int ánh xạ ID giao lộ sang ID đèn, được tính sẵn khi khởi tạo.
     """
     global pending_logic_updates
     try:
-        if shared_dict.get('is_active', False) and 'green_times' in shared_dict:
-            green_times = shared_dict.get('green_times')
+        if shared_dict.get('is_active', False):
+            # Lấy và xóa dữ liệu khỏi shared_dict trong một thao tác để tránh xử lý lặp lại
+            green_times = shared_dict.pop('green_times', None)
             if green_times:
                 # Chỉ lưu lại kế hoạch, không áp dụng ngay
                 pending_logic_updates.update(green_times)
-                logging.info(f"Đã nhận và lên lịch cập nhật cho các giao lộ: {list(green_times.keys())}")
-                # Xóa dữ liệu đã xử lý khỏi shared_dict để tránh lặp lại
-                del shared_dict['green_times']
+                logging.info("Đã nhận và lên lịch cập nhật cho các giao lộ: %s", list(green_times.keys()))
+
+                # Hẹn thời điểm kiểm tra đầu tiên dựa trên lần chuyển pha kế tiếp của từng đèn
+                tls_results = traci.trafficlight.getAllSubscriptionResults()
+                for int_id in green_times:
+                    tl_state = tls_results.get(tl_id_by_int.get(int_id))
+                    if tl_state:
+                        _schedule_check(int_id, tl_state[tc.TL_NEXT_SWITCH], sim_step)
+                    else:
+                        _eligible_at[int_id] = math.inf
+                _update_next_eligible_time()
     except Exception as e:
-        logging.error(f"Lỗi khi chuẩn bị cập nhật logic đèn: {e}", exc_info=True)
+        logging.error("Lỗi khi chuẩn bị cập nhật logic đèn: %s", e, exc_info=True)
 
-def apply_pending_updates_on_cycle_start(config_manager: IntersectionConfigManager, sim_step: float):
+def apply_pending_updates_on_cycle_start(tl_id_by_int: Dict[str, str], sim_step: float):
     """
     Kiểm tra các giao lộ có thay đổi đang chờ và áp dụng chúng khi chu kỳ đèn
-    hiện tại sắp kết thúc. Hàm này phải được gọi mỗi bước mô phỏng.
+    hiện tại sắp kết thúc. Vòng lặp chính chỉ cần gọi hàm này khi thời gian mô phỏng
+    đạt next_eligible_time; các giao lộ chưa đến lượt được bỏ qua.
+    tl_id_by_int ánh xạ ID giao lộ sang ID đèn, được tính sẵn khi khởi tạo.
     """
     global pending_logic_updates
     if not pending_logic_updates:
         return  # Không có gì để làm
 
+    # Trạng thái của tất cả các đèn đã subscribe, SUMO gửi về trong một thông điệp duy nhất
+    tls_results = traci.trafficlight.getAllSubscriptionResults()
+    current_time = traci.simulation.getTime()
+
     # Duyệt qua một bản sao của các keys để có thể xóa phần tử trong vòng lặp
     for int_id in list(pending_logic_updates.keys()):
-        tl_id = config_manager.get_traffic_light_id(int_id)
+        if current_time < _eligible_at.get(int_id, -math.inf):
+            continue  # Chưa đến lần chuyển pha kế tiếp của đèn này
+
+        # Các giao lộ không thể áp dụng (thiếu cấu hình/dữ liệu) được giữ lại nhưng không kiểm tra lại
+        _eligible_at[int_id] = math.inf
+
+        tl_id = tl_id_by_int.get(int_id)
         if not tl_id:
             continue
 
+        tl_state = tls_results.get(tl_id)
+        if not tl_state:
+            continue
+
         try:
             # Lấy thông tin chương trình đèn hiện tại
-            program_logics = traci.trafficlight.getAllProgramLogics(tl_id)
-            current_program_id = traci.trafficlight.getProgram(tl_id)
-            current_logic = next((p for p in program_logics if p.programID == current_program_id), None)
+            current_logic = _program_index.get(tl_id, {}).get(tl_state[tc.TL_CURRENT_PROGRAM])
             if not current_logic:
                 continue
 
-            current_phase_index = traci.trafficlight.getPhase(tl_id)
+            current_phase_index = tl_state[tc.TL_CURRENT_PHASE]
             num_phases = len(current_logic.phases)
-            time_to_next_switch = traci.trafficlight.getNextSwitch(tl_id) - traci.simulation.getTime()
+            time_to_next_switch = tl_state[tc.TL_NEXT_SWITCH] - current_time
 
             # Điều kiện kích hoạt: đang ở pha cuối cùng VÀ thời gian đến lần chuyển tiếp theo
             # rất ngắn (bằng 1 bước mô phỏng), nghĩa là chu kỳ sắp reset.
@@ -163,69 +273,135 @@ def apply_pending_updates_on_cycle_start(config_manager: IntersectionConfigManag
 
             if is_last_phase and is_about_to_reset:
                 new_green_times = pending_logic_updates[int_id]
-                phase_info = config_manager.get_phase_info(int_id)
+                phase_indices = _phase_index_cache.get(int_id)
 
-                if phase_info:
-                    logging.info(f"Áp dụng logic mới cho giao lộ {int_id} (TL: {tl_id}) vào đầu chu kỳ tiếp theo.")
-                    update_traffic_light_logic(tl_id, new_green_times, phase_info)
+                if phase_indices:
+                    logging.info("Áp dụng logic mới cho giao lộ %s (TL: %s) vào đầu chu kỳ tiếp theo.", int_id, tl_id)
+                    update_traffic_light_logic(tl_id, new_green_times, *phase_indices)
                     # Xóa khỏi danh sách chờ sau khi đã áp dụng
                     del pending_logic_updates[int_id]
+                    del _eligible_at[int_id]
                 else:
-                    logging.warning(f"Bỏ qua áp dụng cho {int_id} do thiếu phase_info.")
+                    logging.warning("Bỏ qua áp dụng cho %s do thiếu phase_info.", int_id)
+            else:
+                # Kiểm tra lại ngay trước lần chuyển pha kế tiếp
+                _schedule_check(int_id, tl_state[tc.TL_NEXT_SWITCH], sim_step)
 
         except traci.TraCIException as e:
-            logging.error(f"Lỗi TraCI khi kiểm tra giao lộ {int_id}: {e}")
+            logging.error("Lỗi TraCI khi kiểm tra giao lộ %s: %s", int_id, e)
             # Có thể xóa key nếu giao lộ không còn tồn tại trong mô phỏng
             if "does not exist" in str(e):
                 del pending_logic_updates[int_id]
+                del _eligible_at[int_id]
         except Exception as e:
-            logging.error(f"Lỗi không xác định khi áp dụng cập nhật cho {int_id}: {e}", exc_info=True)
+            logging.error("Lỗi không xác định khi áp dụng cập nhật cho %s: %s", int_id, e, exc_info=True)
+
+    _update_next_eligible_time()
 
 
 # =============================================================================
 # CÁC HÀM HỖ TRỢ VÒNG LẶP MÔ PHỎNG
 # =============================================================================
 
-def get_sum_from_traci_detectors(detector_ids: List[str]) -> int:
+# Các thông số quy đổi độ chiếm dụng (%) của detector thành số xe tích lũy
+ROAD_LENGTH_M = 80.0
+AVERAGE_VEHICLE_LENGTH_M = 3
+NUM_LANES = 1
+# Hệ số quy đổi được tính sẵn một lần: accumulation = occupancy * _ACCUM_FACTOR
+_ACCUM_FACTOR = ROAD_LENGTH_M * NUM_LANES / (100 * AVERAGE_VEHICLE_LENGTH_M)
+
+# Độ chiếm dụng của các detector tại lần lấy mẫu gần nhất
+# Định dạng: { "detector_id": value }
+detector_results = {}
+
+def subscribe_traffic_lights(tl_ids: List[str]):
+    """Đăng ký (subscribe) pha, chương trình và thời điểm chuyển pha của các đèn giao thông."""
+    for tl_id in tl_ids:
+        try:
+            traci.trafficlight.subscribe(tl_id, [tc.TL_CURRENT_PHASE, tc.TL_NEXT_SWITCH, tc.TL_CURRENT_PROGRAM])
+        except traci.TraCIException as e:
+            logging.warning("Không thể subscribe đèn giao thông %s: %s", tl_id, e)
+
+def filter_known_detectors(detector_ids: List[str], known_ids: set) -> List[str]:
+    """
+    Loại bỏ các detector không tồn tại trong mô phỏng (kiểm tra một lần khi khởi tạo),
+    để vòng lặp chính không phải bắt lỗi cho từng detector ở mỗi lần lấy mẫu.
+    """
+    unknown = [det_id for det_id in detector_ids if det_id not in known_ids]
+    if unknown:
+        logging.warning("Bỏ qua %d detector không tồn tại trong SUMO: %s", len(unknown), unknown)
+        return [det_id for det_id in detector_ids if det_id in known_ids]
+    return detector_ids
+
+def refresh_detector_results(detector_ids: List[str]):
+    """
+    Đọc độ chiếm dụng của các detector, mỗi detector một lần. Chỉ gọi tại các thời điểm
+    lấy mẫu: detector không được subscribe vì subscription buộc SUMO gửi (và Python giải mã)
+    giá trị của mọi detector sau từng bước mô phỏng, trong khi chỉ cần đọc mỗi sampling_interval_s.
+    """
+    get_occupancy = traci.lanearea.getLastIntervalOccupancy
+    for det_id in detector_ids:
+        detector_results[det_id] = get_occupancy(det_id)
+
+def get_sum_from_traci_detectors(detector_ids: List[str]) -> float:
     """
     Lấy số lượng phương tiện (tích lũy) dựa trên độ chiếm dụng theo không gian.
-    An toàn trước các lỗi Traci và lỗi chia cho 0.
+    Đọc từ giá trị đã lấy bởi refresh_detector_results(). Các detector
+    đã được kiểm tra khi khởi tạo (filter_known_detectors) nên không cần bắt lỗi ở đây.
     """
-    try:
-        total_accumulation = 0
-        for det_id in detector_ids:
-            space_occupancy = traci.lanearea.getLastIntervalOccupancy(det_id)
-            road_length = 80.00
-            average_length_of_vehicles = 3
-            num_lane = 1
-            # Tính toán tích lũy tại một detector:
-            accumulation = road_length * (num_lane / (100 * average_length_of_vehicles)) * space_occupancy
-            total_accumulation += accumulation
-        return total_accumulation # Trả về 0 nếu không có xe, tốc độ trung bình hoặc interval bằng 0
+    # Tích lũy tại mỗi detector = độ chiếm dụng * _ACCUM_FACTOR, cộng dồn theo đúng thứ tự detector
+    total = 0.0
+    for det_id in detector_ids:
+        total += detector_results[det_id] * _ACCUM_FACTOR
+    return total
 
-    except traci.TraCIException as e:
-        logging.warning(f"Lỗi TraCI trong get_sum_from_traci_detectors: {e}")
-        return 0
 
+def build_queue_streams(solver_detectors: Dict) -> Tuple[List[Tuple], List[List[str]]]:
+    """
+    Gán cho mỗi luồng hàng đợi (pha chính và từng pha phụ của mỗi giao lộ) một chỉ số
+    hàng trong mảng cộng dồn phẳng, thay cho cấu trúc dict lồng nhau theo giao lộ.
 
-def initialize_queue_samples(solver_detectors: Dict) -> Dict:
-    """Khởi tạo cấu trúc dữ liệu để lưu trữ các mẫu hàng đợi."""
-    queue_samples = {}
+    Returns:
+        stream_ids: Định danh của từng hàng, (int_id, 'p') hoặc (int_id, 's', i).
+        stream_detectors: Danh sách detector hàng đợi của từng hàng tương ứng.
+    """
+    stream_ids = []
+    stream_detectors = []
     for int_id, int_details in solver_detectors.items():
-        num_secondary_phases = len(int_details.get('phases', {}).get('s', []))
-        queue_samples[int_id] = {
-            'p': [],
-            's': [[] for _ in range(num_secondary_phases)]
-        }
-    return queue_samples
-
-def clear_samples(n_samples: List, queue_samples: Dict):
-    """Xóa tất cả các mẫu đã thu thập để chuẩn bị cho chu kỳ tổng hợp tiếp theo."""
-    n_samples.clear()
-    for int_id in queue_samples:
-        queue_samples[int_id]['p'].clear()
-        for s_phase_samples in queue_samples[int_id]['s']:
-            s_phase_samples.clear()
+        phases = int_details.get('phases', {})
+        stream_ids.append((int_id, 'p'))
+        stream_detectors.append(phases.get('p', {}).get('queue_detectors', []))
+        for i, s_phase in enumerate(phases.get('s', [])):
+            stream_ids.append((int_id, 's', i))
+            stream_detectors.append(s_phase.get('queue_detectors', []))
+    return stream_ids, stream_detectors
+
+def build_sampling_schedule(algorithm_detector_ids: List[str], stream_ids: List[Tuple],
+                            stream_detectors: List[List[str]]) -> List[Tuple]:
+    """
+    Lập lịch lấy mẫu phẳng gồm các bộ (kind, int_id, row, detector_ids), kind thuộc
+    {'algo', 'p', 's'}. Hàng 0 của bộ cộng dồn dành cho tích lũy n(k) của thuật toán,
+    hàng row = i + 1 dành cho luồng hàng đợi stream_ids[i]. Mỗi lần lấy mẫu chỉ cần
+    duyệt danh sách này một lần.
+    """
+    schedule = [('algo', None, 0, algorithm_detector_ids)]
+    for row, (stream_id, detector_ids) in enumerate(zip(stream_ids, stream_detectors), start=1):
+        schedule.append((stream_id[1], stream_id[0], row, detector_ids))
+    return schedule
+
+def scatter_queue_means(stream_ids: List[Tuple], queue_means: np.ndarray) -> Dict:
+    """
+    Chuyển mảng giá trị trung bình theo hàng về dạng {int_id: {'p': ..., 's': [...]}}
+    mà bộ điều khiển sử dụng.
+    """
+    queue_lengths = {}
+    for stream_id, value in zip(stream_ids, queue_means.tolist()):
+        int_id = stream_id[0]
+        if stream_id[1] == 'p':
+            queue_lengths[int_id] = {'p': value, 's': []}
+        else:
+            queue_lengths[int_id]['s'].append(value)
+    return queue_lengths
 
 # =============================================================================
 # HÀM CHẠY MÔ PHỎNG CHÍNH
@@ -238,10 +414,9 @@ def run_sumo_simulation():
         logging.info("Bắt đầu quá trình khởi tạo mô phỏng...")
 
         # Xác định các đường dẫn file cấu hình
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..')) 
-        sim_config_path = os.path.join(project_root, 'src', 'config', 'simulation.yml')
-        detector_config_path = os.path.join(project_root, 'src', 'config', 'detector_config.json')
-        intersection_config_path = os.path.join(project_root, 'src', 'config', 'intersection_config.json')
+        sim_config_path = str(CONFIG_DIR / 'simulation.yml')
+        detector_config_path = str(CONFIG_DIR / 'detector_config.json')
+        intersection_config_path = str(CONFIG_DIR / 'intersection_config.json')
 
         # Tải các file cấu hình
         sim_config = load_yaml_config(sim_config_path).get('config', {})
@@ -257,136 +432,167 @@ def run_sumo_simulation():
         algorithm_detector_ids = detector_config_mgr.get_algorithm_input_detectors()
         solver_detectors = detector_config_mgr.get_solver_input_detectors()
         flow_algorithm_detector = detector_config_mgr.get_mfd_input_flow_detectors()
-        logging.info(f"Tìm thấy {len(algorithm_detector_ids)} detectors cho thuật toán vành đai.")
-        logging.info(f"Tìm thấy {len(solver_detectors)} giao lộ cho bộ giải cục bộ.")
-        logging.info(f"Tìm thấy {len(flow_algorithm_detector)} detectors cho flow đầu vào thuật toán.")
-
-        # --- 2. THIẾT LẬP MÔI TRƯỜNG ĐA LUỒNG VÀ SUMO ---
-        with Manager() as manager:
-            shared_dict = manager.dict() # Dict để giao tiếp giữa luồng chính và thuật toán
-
-            # Khởi động SUMO
-            sumo_sim = SumoSim(sim_config)
-            output_dir = os.path.join(project_root, "output")
-            os.makedirs(output_dir, exist_ok=True)
-            output_files = {"tripinfo": os.path.join(output_dir, "tripinfo.xml")}
-            sumo_sim.start(output_files=output_files)
-
-            # Khởi tạo bộ điều khiển chính
-            controller = PerimeterController(
-                kp=KP_H, ki=KI_H, n_hat=N_HAT, 
-                config_file=intersection_config_path,
-                shared_dict=shared_dict
-            )
-
-            # Khởi tạo bộ vẽ đồ thị thời gian thực
-            plotter = RealTimePlotter(set_point=controller.n_hat)
-
-            # --- 3. CHUẨN BỊ CHO VÒNG LẶP CHÍNH ---
-            n_previous = 0
-            qg_previous = 0
-            
-            # Biến lưu trữ dữ liệu thu thập được
-            n_samples = []
-            queue_samples = initialize_queue_samples(solver_detectors)
-            
-            # Biến lưu trữ dữ liệu đã được tổng hợp
-            latest_aggregated_n = 0
-            latest_aggregated_queue_lengths = {}
-
-            # Lấy giá trị ban đầu và các thông số mô phỏng
-            sim_step = traci.simulation.getDeltaT()
-            sumo_sim.step()
-            n_previous = get_sum_from_traci_detectors(algorithm_detector_ids)
-            latest_aggregated_n = n_previous
-
-            # Thiết lập các mốc thời gian cho các hành động
-            next_sampling_time = 0
-            next_aggregation_time = aggregation_interval_s
-            next_control_time = CONTROL_INTERVAL_S
-            next_log_time = 10
-
-            logging.info("Khởi tạo hoàn tất. Bắt đầu vòng lặp mô phỏng chính.")
-
-            # --- 4. VÒNG LẶP MÔ PHỎNG CHÍNH ---
-            while traci.simulation.getMinExpectedNumber() > 0:
-                sumo_sim.step()
-                current_time = traci.simulation.getTime()
-
-                # --- BƯỚC 1: THU THẬP DỮ LIỆU MẪU ---
-                if current_time >= next_sampling_time:
-                    n_samples.append(get_sum_from_traci_detectors(algorithm_detector_ids))
-
-                    for int_id, details in solver_detectors.items():
-                        phases = details.get('phases', {})
-                        # Hàng đợi pha chính
-                        p_detectors = phases.get('p', {}).get('queue_detectors', [])
-                        queue_samples[int_id]['p'].append(get_sum_from_traci_detectors(p_detectors))
-                        # Hàng đợi các pha phụ
-                        for i, s_phase in enumerate(phases.get('s', [])):
-                            s_detectors = s_phase.get('queue_detectors', [])
-                            if i < len(queue_samples[int_id]['s']):
-                                queue_samples[int_id]['s'][i].append(get_sum_from_traci_detectors(s_detectors))
-                    
-                    next_sampling_time += sampling_interval_s
-
-                # --- BƯỚC 2: TỔNG HỢP DỮ LIỆU ---
-                if current_time >= next_aggregation_time:
-                    logging.info(f"--- Tổng hợp dữ liệu tại t={current_time:.1f}s ---")
-                    
-                    if n_samples:
-                        latest_aggregated_n = sum(n_samples) / len(n_samples)
-                        # Cập nhật đồ thị với giá trị n(k) mới
-                        plotter.update_plot(current_time, latest_aggregated_n)
-
-                    for int_id, data in queue_samples.items():
-                        avg_p = sum(data['p']) / len(data['p']) if data['p'] else 0
-                        avg_s = [sum(s) / len(s) if s else 0 for s in data['s']]
-                        latest_aggregated_queue_lengths[int_id] = {'p': avg_p, 's': avg_s}
-
-                    logging.info(f"n(k) mới={latest_aggregated_n:.2f}. Xóa {len(n_samples)} mẫu.")
-                    clear_samples(n_samples, queue_samples)
-                    next_aggregation_time += aggregation_interval_s
-
-                # --- BƯỚC 3: CHẠY THUẬT TOÁN ĐIỀU KHIỂN ---
-                if current_time >= next_control_time:
-                    logging.info(f"--- Chạy điều khiển tại t={current_time:.1f}s ---")
-                    
-                    # Chạy thuật toán để tính toán thời gian xanh mới và lưu vào shared_dict
-                    result = controller.run_simulation_step(
-                        latest_aggregated_n, n_previous, qg_previous, latest_aggregated_queue_lengths
-                    )
-                    
-                    # Chuẩn bị/lên lịch cập nhật thay vì áp dụng ngay
-                    prepare_logic_update(shared_dict)
-
-                    # Cập nhật các biến trạng thái cho chu kỳ tiếp theo
-                    qg_previous = result.qg_new
-                    n_previous = latest_aggregated_n
-                    next_control_time += CONTROL_INTERVAL_S
+        logging.info("Tìm thấy %d detectors cho thuật toán vành đai.", len(algorithm_detector_ids))
+        logging.info("Tìm thấy %d giao lộ cho bộ giải cục bộ.", len(solver_detectors))
+        logging.info("Tìm thấy %d detectors cho flow đầu vào thuật toán.", len(flow_algorithm_detector))
+
+        # --- 2. THIẾT LẬP MÔI TRƯỜNG GIAO TIẾP VÀ SUMO ---
+        # Dict để giao tiếp giữa vòng lặp chính và bộ điều khiển. Bộ điều khiển chạy đồng bộ
+        # trong cùng luồng nên dùng dict thường, không cần Manager() với proxy qua tiến trình riêng.
+        shared_dict = {}
+
+        # Khởi động SUMO
+        sumo_sim = SumoSim(sim_config)
+        OUTPUT_DIR.mkdir(exist_ok=True)
+        output_files = {"tripinfo": str(OUTPUT_DIR / "tripinfo.xml")}
+        sumo_sim.start(output_files=output_files)
+
+        # Khởi tạo bộ điều khiển chính
+        controller = PerimeterController(
+            kp=KP_H, ki=KI_H, n_hat=N_HAT, 
+            config_file=intersection_config_path,
+            shared_dict=shared_dict
+        )
+
+        # Khởi tạo bộ vẽ đồ thị thời gian thực
+        plotter = RealTimePlotter(set_point=controller.n_hat)
+
+        # --- 3. CHUẨN BỊ CHO VÒNG LẶP CHÍNH ---
+        n_previous = 0
+        qg_previous = 0
+        
+        # Bộ cộng dồn (tổng, số mẫu) của dữ liệu thu thập được. Mọi luồng được lấy mẫu
+        # cùng lúc nên dùng chung một bộ đếm n_count.
+        n_count = 0
+        stream_ids, stream_detectors = build_queue_streams(solver_detectors)
+
+        # Kiểm tra một lần các detector có tồn tại trong mô phỏng
+        known_detector_ids = set(traci.lanearea.getIDList())
+        algorithm_detector_ids = filter_known_detectors(algorithm_detector_ids, known_detector_ids)
+        stream_detectors = [filter_known_detectors(ids, known_detector_ids) for ids in stream_detectors]
+
+        # Hàng 0: tích lũy n(k); các hàng sau: hàng đợi của từng luồng
+        sampling_schedule = build_sampling_schedule(algorithm_detector_ids, stream_ids, stream_detectors)
+        sample_sums = np.zeros(len(sampling_schedule), dtype=np.float64)
+        sample_means = np.zeros_like(sample_sums)
+        
+        # Biến lưu trữ dữ liệu đã được tổng hợp
+        latest_aggregated_n = 0
+        latest_aggregated_queue_lengths = {}
+
+        # Danh sách detector (không trùng lặp) cần đọc tại mỗi lần lấy mẫu
+        queue_detector_ids = [det_id for detector_ids in stream_detectors for det_id in detector_ids]
+        sampled_detector_ids = list(dict.fromkeys(algorithm_detector_ids + queue_detector_ids))
+        # Đăng ký nhận trạng thái đèn theo từng bước
+        # Ánh xạ giao lộ -> đèn được tính một lần, dùng lại trong vòng lặp chính
+        tl_id_by_int = {int_id: intersection_config_mgr.get_traffic_light_id(int_id) for int_id in intersection_config_mgr.get_intersection_ids()}
+        tl_id_by_int = {int_id: tl_id for int_id, tl_id in tl_id_by_int.items() if tl_id}
+        tl_ids = list(tl_id_by_int.values())
+        subscribe_traffic_lights(tl_ids)
+        build_program_index(tl_ids)
+        build_phase_index_cache(intersection_config_mgr)
+
+        # Lấy giá trị ban đầu và các thông số mô phỏng
+        sim_step = traci.simulation.getDeltaT()
+        sumo_sim.step()
+        refresh_detector_results(sampled_detector_ids)
+        n_previous = get_sum_from_traci_detectors(algorithm_detector_ids)
+        latest_aggregated_n = n_previous
+
+        # Thiết lập các mốc thời gian cho các hành động
+        next_sampling_time = 0
+        next_aggregation_time = aggregation_interval_s
+        next_control_time = CONTROL_INTERVAL_S
+        next_log_time = 10
+
+        logging.info("Khởi tạo hoàn tất. Bắt đầu vòng lặp mô phỏng chính.")
+
+        # Gán các hàm gọi ở mỗi bước vào biến cục bộ để tránh tra cứu thuộc tính lặp lại
+        sim_step_fn = sumo_sim.step
+        get_time = traci.simulation.getTime
+        min_expected = traci.simulation.getMinExpectedNumber
+        refresh_detectors = refresh_detector_results
+        get_detector_sum = get_sum_from_traci_detectors
+        apply_pending = apply_pending_updates_on_cycle_start
+
+        # --- 4. VÒNG LẶP MÔ PHỎNG CHÍNH ---
+        while min_expected() > 0:
+            sim_step_fn()
+            current_time = get_time()
+
+            # --- BƯỚC 1: THU THẬP DỮ LIỆU MẪU ---
+            if current_time >= next_sampling_time:
+                refresh_detectors(sampled_detector_ids)
+                # Tích lũy n(k) và hàng đợi pha chính/pha phụ của mọi giao lộ trong một lượt duyệt
+                for _kind, _int_id, row, detector_ids in sampling_schedule:
+                    sample_sums[row] += get_detector_sum(detector_ids)
+                n_count += 1
+
+                next_sampling_time += sampling_interval_s
+
+            # --- BƯỚC 2: TỔNG HỢP DỮ LIỆU ---
+            if current_time >= next_aggregation_time:
+                logging.info("--- Tổng hợp dữ liệu tại t=%.1fs ---", current_time)
                 
-                # --- BƯỚC 4: ÁP DỤNG CÁC CẬP NHẬT ĐANG CHỜ (MỖI BƯỚC) ---
-                apply_pending_updates_on_cycle_start(intersection_config_mgr, sim_step)
+                # Trung bình của mọi hàng được tính trong một phép chia vector
+                if n_count:
+                    np.divide(sample_sums, n_count, out=sample_means)
+                    latest_aggregated_n = float(sample_means[0])
+                    # Cập nhật đồ thị với giá trị n(k) mới
+                    plotter.update_plot(current_time, latest_aggregated_n)
+                else:
+                    sample_means.fill(0.0)
+
+                latest_aggregated_queue_lengths = scatter_queue_means(stream_ids, sample_means[1:])
+
+                logging.info("n(k) mới=%.2f. Xóa %d mẫu.", latest_aggregated_n, n_count)
+                # Đặt lại bộ cộng dồn cho chu kỳ tổng hợp tiếp theo
+                n_count = 0
+                sample_sums.fill(0.0)
+                next_aggregation_time += aggregation_interval_s
+
+            # --- BƯỚC 3: CHẠY THUẬT TOÁN ĐIỀU KHIỂN ---
+            if current_time >= next_control_time:
+                logging.info("--- Chạy điều khiển tại t=%.1fs ---", current_time)
+                
+                # Chạy thuật toán để tính toán thời gian xanh mới và lưu vào shared_dict
+                result = controller.run_simulation_step(
+                    latest_aggregated_n, n_previous, qg_previous, latest_aggregated_queue_lengths
+                )
+                
+                # Chuẩn bị/lên lịch cập nhật thay vì áp dụng ngay
+                prepare_logic_update(shared_dict, tl_id_by_int, sim_step)
+
+                # Cập nhật các biến trạng thái cho chu kỳ tiếp theo
+                qg_previous = result.qg_new
+                n_previous = latest_aggregated_n
+                next_control_time += CONTROL_INTERVAL_S
+            
+            # --- BƯỚC 4: ÁP DỤNG CÁC CẬP NHẬT ĐANG CHỜ ---
+            # Chỉ kiểm tra khi có giao lộ đang chờ sắp đến lần chuyển pha kế tiếp
+            if current_time >= next_eligible_time:
+                apply_pending(tl_id_by_int, sim_step)
 
-                # Ghi log tiến độ và kiểm tra điều kiện dừng
-                if current_time >= next_log_time:
-                    logging.info(f"Thời gian: {current_time:.0f}s / {total_simulation_time}s")
-                    next_log_time += 10
+            # Ghi log tiến độ và kiểm tra điều kiện dừng
+            if current_time >= next_log_time:
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info("Thời gian: %.0fs / %ss", current_time, total_simulation_time)
+                next_log_time += 10
 
-                if current_time >= total_simulation_time:
-                    logging.info(f"Đạt thời gian mô phỏng tối đa. Dừng lại.")
-                    break
+            if current_time >= total_simulation_time:
+                logging.info("Đạt thời gian mô phỏng tối đa. Dừng lại.")
+                break
 
     except (traci.TraCIException, traci.FatalTraCIError) as e:
-        logging.warning(f"Kết nối Traci bị đóng hoặc mô phỏng kết thúc sớm: {e}")
+        logging.warning("Kết nối Traci bị đóng hoặc mô phỏng kết thúc sớm: %s", e)
     except Exception as e:
-        logging.error(f"Lỗi không mong muốn trong quá trình chạy mô phỏng: {e}", exc_info=True)
+        logging.error("Lỗi không mong muốn trong quá trình chạy mô phỏng: %s", e, exc_info=True)
     finally:
         # --- 5. DỌN DẸP VÀ KẾT THÚC ---
         logging.info("Đóng mô phỏng.")
         if 'sumo_sim' in locals() and sumo_sim.is_running():
             sumo_sim.close()
-            logging.info(f"Mô phỏng kết thúc. Tổng số bước: {sumo_sim.get_step_counts()}")
+            logging.info("Mô phỏng kết thúc. Tổng số bước: %s", sumo_sim.get_step_counts())
 
         # Giữ đồ thị hiển thị cho đến khi người dùng đóng nó
         if 'plotter' in locals() and plotter is not None:
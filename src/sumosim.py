@@ -12,14 +12,25 @@ else:
     sys.exit("Please declare environment variable 'SUMO_HOME'")
 
 # Step 3: Import SUMO libraries
+# Set USE_LIBSUMO=1 to run SUMO in-process through libsumo (no TCP round-trip per call).
+# TraCI stays the default since it supports sumo-gui and is easier to debug.
+USE_LIBSUMO = os.environ.get('USE_LIBSUMO', '0') == '1'
+
 import numpy as np
-import traci
+if USE_LIBSUMO:
+    import libsumo as traci
+else:
+    import traci
 import sumolib
 
 class SumoSim:
     def __init__(self, config: dict):
         self.config = config
-        self.sumo_binary = sumolib.checkBinary('sumo-gui' if self.config['gui'] else 'sumo')
+        # libsumo cannot drive sumo-gui, so the GUI is disabled when it is active
+        self.gui = self.config['gui'] and not USE_LIBSUMO
+        if self.config['gui'] and USE_LIBSUMO:
+            logging.warning("GUI is not supported with libsumo (USE_LIBSUMO=1), running without GUI.")
+        self.sumo_binary = sumolib.checkBinary('sumo-gui' if self.gui else 'sumo')
         self.step_count = 0
         self._running = False
 
@@ -41,7 +52,7 @@ class SumoSim:
             if 'vehroute' in output_files:
                 sumo_cmd.extend(["--vehroute-output", output_files['vehroute']])
 
-        if self.config['gui']:
+        if self.gui:
             sumo_cmd.append("--start")
 
         try:
@@ -1,24 +1,38 @@
-
+import tempfile
 import matplotlib.pyplot as plt
-from typing import List
+import numpy as np
+from typing import List, Optional
 
 class RealTimePlotter:
     """
     Một lớp để vẽ đồ thị dữ liệu theo thời gian thực bằng Matplotlib mà không chặn luồng chính.
+    Chỉ vẽ lại đường dữ liệu bằng kỹ thuật blitting; toàn bộ canvas chỉ được vẽ lại khi
+    giới hạn trục thay đổi. Bộ nhớ chỉ giữ tối đa max_points điểm gần nhất; các điểm cũ
+    hơn được ghi nối tiếp ra file nhị phân history_file (hoặc file tạm nếu không chỉ định).
     """
-    def __init__(self, set_point: float, title: str = "Accumulation Plot", y_label: str = "Tích lũy (n(k))", x_label: str = "Thời gian (s)"):
+    def __init__(self, set_point: float, title: str = "Accumulation Plot", y_label: str = "Tích lũy (n(k))", x_label: str = "Thời gian (s)",
+                 redraw_every: int = 10, max_points: int = 500, history_file: Optional[str] = None):
         plt.ion()  # Bật chế độ tương tác
         self.fig, self.ax = plt.subplots(figsize=(10, 6))
         self.set_point = set_point
-        
+        # Chỉ vẽ lại sau mỗi redraw_every điểm dữ liệu mới
+        self.redraw_every = max(1, redraw_every)
+
         # Lưu trữ dữ liệu
         self.time_data: List[float] = []
         self.nk_data: List[float] = []
-        
-        # Các thành phần của đồ thị
-        self.line, = self.ax.plot(self.time_data, self.nk_data, 'b-', label='Tích lũy n(k)') 
+        self._num_points = 0
+
+        # Lịch sử đã ghi ra đĩa: các cặp (t, n(k)) kiểu float64, mở khi ghi lần đầu
+        self._max_points = max(2, max_points)
+        self._history_path = history_file
+        self._history = None
+
+        # Các thành phần của đồ thị. Đường dữ liệu được đánh dấu animated để không nằm
+        # trong ảnh nền dùng cho blitting.
+        self.line, = self.ax.plot(self.time_data, self.nk_data, 'b-', label='Tích lũy n(k)', animated=True)
         self.set_point_line = self.ax.axhline(y=self.set_point, color='r', linestyle='--', label=f'Điểm đặt n_hat={self.set_point:.0f}')
-        
+
         # Nhãn và tiêu đề
         self.ax.set_xlabel(x_label)
         self.ax.set_ylabel(y_label)
@@ -27,28 +41,102 @@ class RealTimePlotter:
         self.ax.grid(True)
         self.fig.tight_layout()
 
+        # Mỗi lần canvas được vẽ lại toàn bộ (kể cả do cửa sổ đổi kích thước hay GUI tự vẽ),
+        # chụp lại ảnh nền và vẽ lại đường dữ liệu. Sau đó vẽ toàn bộ một lần.
+        self._supports_blit = getattr(self.fig.canvas, 'supports_blit', False)
+        self._background = None
+        self._draw_cid = self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.fig.canvas.draw()
+
+    def _on_draw(self, event):
+        """Xử lý draw_event: chụp ảnh nền vùng trục (không gồm đường dữ liệu) rồi vẽ đường dữ liệu lên."""
+        if self._supports_blit:
+            self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
+
+    def _expand_limits_if_needed(self) -> bool:
+        """
+        Mở rộng giới hạn trục (có chừa khoảng trống) khi dữ liệu mới vượt ra ngoài.
+        Trả về True nếu giới hạn đã thay đổi và cần vẽ lại toàn bộ.
+        """
+        x_min, x_max = self.ax.get_xlim()
+        y_min, y_max = self.ax.get_ylim()
+        t_min, t_max = self.time_data[0], self.time_data[-1]
+        nk_min, nk_max = min(self.nk_data), max(self.nk_data)
+        nk_min, nk_max = min(nk_min, self.set_point), max(nk_max, self.set_point)
+
+        changed = False
+        if t_min < x_min or t_max > x_max:
+            span = max(t_max - t_min, 1.0)
+            self.ax.set_xlim(t_min, t_max + 0.5 * span)
+            changed = True
+        if nk_min < y_min or nk_max > y_max:
+            margin = 0.2 * max(nk_max - nk_min, 1.0)
+            self.ax.set_ylim(nk_min - margin, nk_max + margin)
+            changed = True
+        return changed
+
+    def _redraw(self):
+        """Vẽ lại đường dữ liệu, dùng blitting nếu giới hạn trục không đổi."""
+        self.line.set_data(self.time_data, self.nk_data)
+
+        if self._expand_limits_if_needed() or self._background is None:
+            # _on_draw chụp lại ảnh nền và vẽ đường dữ liệu
+            self.fig.canvas.draw()
+        else:
+            self.fig.canvas.restore_region(self._background)
+            self.ax.draw_artist(self.line)
+            self.fig.canvas.blit(self.ax.bbox)
+        self.fig.canvas.flush_events()
+
+    def _flush_oldest(self):
+        """Ghi nối tiếp nửa cũ nhất của dữ liệu trong bộ nhớ ra file lịch sử rồi xóa khỏi danh sách."""
+        half = len(self.time_data) // 2
+        if self._history is None:
+            self._history = open(self._history_path, 'w+b') if self._history_path else tempfile.TemporaryFile()
+        chunk = np.column_stack((self.time_data[:half], self.nk_data[:half])).astype(np.float64)
+        chunk.tofile(self._history)
+        del self.time_data[:half]
+        del self.nk_data[:half]
+
+    def _load_full_history(self):
+        """Trả về toàn bộ dữ liệu (phần đã ghi ra file + phần trong bộ nhớ)."""
+        if self._history is None:
+            return self.time_data, self.nk_data
+        self._history.flush()
+        self._history.seek(0)
+        stored = np.frombuffer(self._history.read(), dtype=np.float64).reshape(-1, 2)
+        times = np.concatenate((stored[:, 0], self.time_data))
+        values = np.concatenate((stored[:, 1], self.nk_data))
+        return times, values
+
     def update_plot(self, time_step: float, nk_value: float):
         """Cập nhật đồ thị với một điểm dữ liệu mới."""
         # Thêm dữ liệu mới
         self.time_data.append(time_step)
         self.nk_data.append(nk_value)
-        
-        # Cập nhật dữ liệu cho đường vẽ
-        self.line.set_xdata(self.time_data)
-        self.line.set_ydata(self.nk_data)
-        
-        # Tự động điều chỉnh lại giới hạn của các trục
-        self.ax.relim()
-        self.ax.autoscale_view()
-        
-        # Vẽ lại canvas
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
-        
-        # Tạm dừng một chút để giao diện đồ họa có thời gian cập nhật
-        plt.pause(0.01)
+        self._num_points += 1
+
+        # Giới hạn số điểm giữ trong bộ nhớ
+        if len(self.time_data) > self._max_points:
+            self._flush_oldest()
+
+        # Giảm tần suất vẽ lại để không làm chậm vòng lặp mô phỏng
+        if self._num_points % self.redraw_every:
+            return
+        self._redraw()
 
     def close(self):
         """Giữ đồ thị hiển thị sau khi mô phỏng kết thúc."""
+        # Vẽ đầy đủ các điểm cuối cùng (có thể chưa được vẽ do giảm tần suất)
+        self.fig.canvas.mpl_disconnect(self._draw_cid)
+        self.line.set_animated(False)
+        self.line.set_data(*self._load_full_history())
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+        self.ax.set_autoscale_on(True)
+        self.ax.relim()
+        self.ax.autoscale_view()
         plt.ioff() # Tắt chế độ tương tác
         plt.show() # Hiển thị đồ thị cuối cùng (hành động này sẽ chặn cho đến khi người dùng đóng cửa sổ)
@@ -0,0 +1,54 @@
+"""
+Shared I/O helpers for the config generators in tools/ (generate_detector_config.py,
+generate_intersection_config.py).
+"""
+
+import json
+# Prefer the C-based orjson serializer; fall back to the standard library json
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:
+    _HAS_ORJSON = False
+# Prefer the C-based lxml parser; fall back to the standard library ElementTree
+try:
+    from lxml import etree as ET
+    _HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _HAS_LXML = False
+
+def iter_elements(xml_file, tags):
+    """
+    Stream the top-level elements whose tag is in `tags`, in document order.
+    Each element is complete (children included) when yielded and is freed, together
+    with its preceding siblings, once the caller moves on, so memory stays bounded
+    regardless of file size. With lxml, huge_tree lifts the text-node size limit
+    for large networks and collect_ids=False skips the unused id index.
+
+    The file stays open until the generator is exhausted or closed; callers that
+    stop early should wrap it in contextlib.closing().
+    """
+    with open(xml_file, 'rb') as source:
+        if _HAS_LXML:
+            for _, elem in ET.iterparse(source, events=('end',), tag=tags, huge_tree=True, collect_ids=False):
+                yield elem
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        else:
+            context = ET.iterparse(source, events=('start', 'end'))
+            _, root = next(context)
+            for event, elem in context:
+                if event == 'end' and elem.tag in tags:
+                    yield elem
+                    root.clear()
+
+def write_json(data, output_file):
+    """Write `data` as JSON indented by 2 spaces, using orjson when available."""
+    if _HAS_ORJSON:
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
@@ -1,8 +1,12 @@
 import os
-import json
-import xml.etree.ElementTree as ET
+import sys
 import argparse
 import math
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from config_io import iter_elements, write_json
 
 """
 HƯỚNG DẪN SỬ DỤNG:
@@ -18,6 +22,8 @@ Tùy chọn dòng lệnh:
   --add-file <path>: Đường dẫn đến file detector.add.xml (Mặc định: src/network_test/detector.add.xml)
   --output <path>: Đường dẫn file output json (Mặc định: detector_config_generated.json)
   --boundary-buffer <float>: Khoảng cách (mét) từ biên mạng lưới để coi một nút là nút biên (Mặc định: 50.0)
+  --workers <int>: Số tiến trình dùng để xử lý song song các nút giao (Mặc định: 1, chạy tuần tự)
+  --emit-comments: Thêm trường "comment" ("Secondary Phase i") vào mỗi pha phụ trong output (Mặc định: tắt)
 
 Logic lọc nút giao biên (Outer Intersections):
 - Script sẽ xác định các "Nút biên" (Boundary Nodes) dựa trên:
@@ -36,131 +42,224 @@ def parse_detectors(add_file):
         all_e1: list of all e1 ids
         all_e2: list of all e2 ids
     """
-    tree = ET.parse(add_file)
-    root = tree.getroot()
-    
-    lane_to_e1 = {}
-    lane_to_e2 = {}
+    lane_to_e1 = defaultdict(list)
+    lane_to_e2 = defaultdict(list)
     all_e1 = []
     all_e2 = []
 
-    # Parse E1 (inductionLoop)
-    for detector in root.findall('inductionLoop'):
+    for detector in iter_elements(add_file, ('inductionLoop', 'laneAreaDetector')):
         det_id = detector.get('id')
-        lane_id = detector.get('lane')
-        all_e1.append(det_id)
-        if lane_id not in lane_to_e1:
-            lane_to_e1[lane_id] = []
-        lane_to_e1[lane_id].append(det_id)
-
-    # Parse E2 (laneAreaDetector)
-    for detector in root.findall('laneAreaDetector'):
-        det_id = detector.get('id')
-        lane_id = detector.get('lane')
-        all_e2.append(det_id)
-        if lane_id not in lane_to_e2:
-            lane_to_e2[lane_id] = []
-        lane_to_e2[lane_id].append(det_id)
+        # Interned: lane ids are dict keys looked up again for every connection
+        lane_id = sys.intern(detector.get('lane'))
+        if detector.tag == 'inductionLoop':
+            # E1
+            all_e1.append(det_id)
+            lane_to_e1[lane_id].append(det_id)
+        else:
+            # E2
+            all_e2.append(det_id)
+            lane_to_e2[lane_id].append(det_id)
         
-    return lane_to_e1, lane_to_e2, all_e1, all_e2
+    # Plain dicts so that lookups of unknown lanes do not insert empty entries
+    return dict(lane_to_e1), dict(lane_to_e2), all_e1, all_e2
 
 def parse_network(net_file):
     """
     Parse .net.xml to get intersections, phases, connections, nodes, and edges.
+    The file is streamed in a single pass.
+
+    Nodes are returned column-wise as a dict of parallel sequences:
+        {'ids': [...], 'x': float64 array, 'y': float64 array, 'type': [...], 'incLanes': [...]}
+    where 'incLanes' holds the raw space-separated attribute of each node.
     """
-    tree = ET.parse(net_file)
-    root = tree.getroot()
-    
     intersections = {}
-    tl_connections = {}
-    nodes = {}
+    tl_connections = defaultdict(lambda: defaultdict(list))
+    node_ids = []
+    node_xs = []
+    node_ys = []
+    node_types = []
+    node_inc_lanes = []
     edges = {}
-    
-    # Parse Location for Boundary
-    location = root.find('location')
     conv_boundary = [0, 0, 0, 0]
-    if location is not None:
-        boundary_str = location.get('convBoundary')
-        if boundary_str:
-            conv_boundary = [float(x) for x in boundary_str.split(',')] # minX, minY, maxX, maxY
-
-    # Parse Junctions (Nodes)
-    for junction in root.findall('junction'):
-        jid = junction.get('id')
-        if jid.startswith(':'): continue # Skip internal junctions
-        
-        nodes[jid] = {
-            'x': float(junction.get('x')),
-            'y': float(junction.get('y')),
-            'type': junction.get('type'),
-            'incLanes': junction.get('incLanes', '').split()
-        }
 
-    # Parse Edges
-    for edge in root.findall('edge'):
-        eid = edge.get('id')
-        if eid.startswith(':'): continue # Skip internal edges
-        
-        edges[eid] = {
-            'from': edge.get('from'),
-            'to': edge.get('to')
-        }
+    for elem in iter_elements(net_file, ('location', 'junction', 'edge', 'tlLogic', 'connection')):
+        tag = elem.tag
+
+        if tag == 'connection':
+            tl_id = elem.get('tl')
+            if tl_id:
+                link_index = int(elem.get('linkIndex'))
+                from_edge = elem.get('from')
+                from_lane_idx = elem.get('fromLane')
+                lane_id = sys.intern(f"{from_edge}_{from_lane_idx}")
+                tl_connections[tl_id][link_index].append(lane_id)
 
-    # Parse Traffic Light Logics
-    for tl in root.findall('tlLogic'):
-        tl_id = tl.get('id')
-        phases = []
-        for phase in tl.findall('phase'):
-            state = phase.get('state')
-            duration = phase.get('duration')
-            phases.append({'state': state, 'duration': duration})
-        intersections[tl_id] = phases
-
-    # Parse Connections
-    for conn in root.findall('connection'):
-        tl_id = conn.get('tl')
-        if tl_id:
-            link_index = int(conn.get('linkIndex'))
-            from_edge = conn.get('from')
-            from_lane_idx = conn.get('fromLane')
-            lane_id = f"{from_edge}_{from_lane_idx}"
+        elif tag == 'edge':
+            eid = elem.get('id')
+            if eid[0] == ':': continue # Skip internal edges before reading other attributes
+            eid = sys.intern(eid)
             
-            if tl_id not in tl_connections:
-                tl_connections[tl_id] = {}
-            if link_index not in tl_connections[tl_id]:
-                tl_connections[tl_id][link_index] = []
-            tl_connections[tl_id][link_index].append(lane_id)
+            edges[eid] = {
+                'from': elem.get('from'),
+                'to': elem.get('to')
+            }
+
+        elif tag == 'junction':
+            jid = elem.get('id')
+            if jid[0] == ':': continue # Skip internal junctions before reading other attributes
+            
+            node_ids.append(jid)
+            node_xs.append(elem.get('x'))
+            node_ys.append(elem.get('y'))
+            node_types.append(elem.get('type'))
+            node_inc_lanes.append(elem.get('incLanes', ''))
+
+        elif tag == 'tlLogic':
+            tl_id = elem.get('id')
+            phases = []
+            for phase in elem.findall('phase'):
+                state = phase.get('state')
+                duration = phase.get('duration')
+                phases.append({'state': state, 'duration': duration})
+            intersections[tl_id] = phases
+
+        else:
+            # Location for Boundary
+            boundary_str = elem.get('convBoundary')
+            if boundary_str:
+                conv_boundary = [float(x) for x in boundary_str.split(',')] # minX, minY, maxX, maxY
+
+    # Back to plain dicts so that lookups of unknown ids do not insert empty entries
+    tl_connections = {tl_id: dict(links) for tl_id, links in tl_connections.items()}
+
+    # Coordinates are converted from strings in bulk
+    nodes = {
+        'ids': node_ids,
+        'x': np.array(node_xs, dtype=np.float64),
+        'y': np.array(node_ys, dtype=np.float64),
+        'type': node_types,
+        'incLanes': node_inc_lanes
+    }
             
     return intersections, tl_connections, nodes, edges, conv_boundary
 
-def is_boundary_node(node_id, node_data, conv_boundary, buffer=50.0):
+def find_boundary_nodes(nodes, conv_boundary, buffer=50.0):
     """
-    Check if a node is a boundary node.
+    Return the set of boundary node ids, given the column-wise nodes from
+    parse_network. All checks are evaluated for all nodes at once on NumPy arrays.
     """
-    # Check type
-    if node_data['type'] == 'dead_end':
-        return True
-    
-    # Check coordinates
-    x, y = node_data['x'], node_data['y']
+    node_ids = nodes['ids']
+    xs, ys = nodes['x'], nodes['y']
     minX, minY, maxX, maxY = conv_boundary
-    
-    if (x <= minX + buffer) or (x >= maxX - buffer) or \
-       (y <= minY + buffer) or (y >= maxY - buffer):
-        return True
-        
+
+    # Check coordinates
+    mask = (xs <= minX + buffer) | (xs >= maxX - buffer) | \
+           (ys <= minY + buffer) | (ys >= maxY - buffer)
+
+    # Check type
+    mask |= np.array(nodes['type'], dtype=object) == 'dead_end'
+
     # Check if source node (no incoming lanes - simplified check via incLanes attribute)
     # Note: incLanes might be empty for source nodes
-    if not node_data['incLanes'] or node_data['incLanes'] == ['']:
-        return True
+    mask |= np.fromiter((not inc.strip() for inc in nodes['incLanes']), dtype=bool, count=len(node_ids))
 
-    return False
+    return {node_ids[i] for i in np.flatnonzero(mask)}
 
 def get_edge_from_lane(lane_id):
-    # Lane ID is usually edgeID_index
-    return "_".join(lane_id.split("_")[:-1])
+    # Lane ID is usually edgeID_index; strip everything after the last underscore
+    return lane_id.rpartition("_")[0]
+
+# Read-only lookup tables used by _process_intersection, set once per process by _init_worker
+_lane_to_e1 = {}
+_lane_to_e2 = {}
+_boundary_lanes = frozenset()
+_target_intersections = None
+_emit_comments = False
+
+def _init_worker(lane_to_e1, lane_to_e2, boundary_lanes, target_intersections, emit_comments):
+    """Pool initializer: install the shared lookup tables in the current process."""
+    global _lane_to_e1, _lane_to_e2, _boundary_lanes, _target_intersections, _emit_comments
+    _lane_to_e1 = lane_to_e1
+    _lane_to_e2 = lane_to_e2
+    _boundary_lanes = boundary_lanes
+    _target_intersections = target_intersections
+    _emit_comments = emit_comments
+
+def _process_intersection(task):
+    """
+    Collect the green-phase detectors of one intersection.
+    Returns (tl_id, tl_data), or None if the intersection is not included.
+    """
+    tl_id, phases, conns = task
+    lane_to_e1, lane_to_e2 = _lane_to_e1, _lane_to_e2
+    boundary_lanes = _boundary_lanes
+    target_intersections = _target_intersections
+
+    green_phases = []
+    
+    is_outer_intersection = False
+    # The boundary check only matters without explicit targets, and only until the first hit
+    need_boundary_check = not target_intersections
+
+    for i, phase in enumerate(phases):
+        state = phase.get('state')
+
+        # Dicts used as insertion-ordered sets: O(1) de-duplication, first-seen order kept
+        queue_detectors = {}  # E2
+        queue2_detector = {}  # E1
+
+        # Link indices that are green in this phase (either 'G' or 'g')
+        green_links = [link_idx for link_idx, char in enumerate(state) if char in 'gG']
+        
+        for link_idx in green_links:
+            lanes = conns.get(link_idx)
+            if lanes is None:
+                continue
+            for lane in lanes:
+                # Check if this lane has detectors and comes from a boundary node
+                if need_boundary_check and lane in boundary_lanes:
+                    is_outer_intersection = True
+                    need_boundary_check = False
+
+                # Add E2 detectors
+                if lane in lane_to_e2:
+                    queue_detectors.update(dict.fromkeys(lane_to_e2[lane]))
+                
+                # Add E1 detectors
+                if lane in lane_to_e1:
+                    queue2_detector.update(dict.fromkeys(lane_to_e1[lane]))
+
+        if queue_detectors or queue2_detector:
+            green_phases.append({
+                "queue_detectors": list(queue_detectors),
+                "queue2_detector": list(queue2_detector)
+            })
 
-def generate_config(net_file, add_file, output_file, boundary_buffer, target_intersections=None):
+    # Determine if we should include this intersection
+    should_include = False
+    if target_intersections is not None and len(target_intersections) > 0:
+        if tl_id in target_intersections:
+            should_include = True
+    else:
+        if is_outer_intersection:
+            should_include = True
+
+    # Only add this intersection if it meets criteria
+    if not (should_include and green_phases):
+        return None
+
+    if _emit_comments:
+        secondary_phases = [
+            {**phase_obj, "comment": f"Secondary Phase {i}"}
+            for i, phase_obj in enumerate(green_phases[1:], 1)
+        ]
+    else:
+        secondary_phases = green_phases[1:]
+
+    tl_data = {"phases": {"p": green_phases[0], "s": secondary_phases}}
+    return tl_id, tl_data
+
+def generate_config(net_file, add_file, output_file, boundary_buffer, target_intersections=None, workers=1, emit_comments=False):
     print(f"Reading network from: {net_file}")
     print(f"Reading detectors from: {add_file}")
 
@@ -170,92 +269,36 @@ def generate_config(net_file, add_file, output_file, boundary_buffer, target_int
     print(f"Network Boundary: {conv_boundary}")
     
     if target_intersections:
-        print(f"Filtering for specific intersections: {target_intersections}")
+        # Set for O(1) membership tests in the intersection loop
+        target_intersections = frozenset(target_intersections)
+        print(f"Filtering for specific intersections: {sorted(target_intersections)}")
     else:
         print(f"Filtering for outer intersections (buffer={boundary_buffer}m)")
     
     # Identify Boundary Nodes
-    boundary_nodes = set()
-    for nid, data in nodes.items():
-        if is_boundary_node(nid, data, conv_boundary, boundary_buffer):
-            boundary_nodes.add(nid)
+    boundary_nodes = find_boundary_nodes(nodes, conv_boundary, boundary_buffer)
     
     print(f"Found {len(boundary_nodes)} boundary nodes.")
 
-    solver_input_detectors = {}
-
-    for tl_id, phases in intersections.items():
-        if tl_id not in tl_connections:
-            continue
+    # Lanes with detectors that come from a boundary node, computed once for all phases
+    edge_from = {eid: data['from'] for eid, data in edges.items()}
+    boundary_lanes = {
+        lane for lane in (lane_to_e1.keys() | lane_to_e2.keys())
+        if edge_from.get(get_edge_from_lane(lane)) in boundary_nodes
+    }
 
-        tl_data = {"phases": {}}
-        green_phases = []
-        
-        is_outer_intersection = False
+    # Each intersection is processed independently; the lookup tables are shared
+    # read-only, once per worker process, through the pool initializer.
+    tasks = [(tl_id, phases, tl_connections[tl_id]) for tl_id, phases in intersections.items() if tl_id in tl_connections]
+    init_args = (lane_to_e1, lane_to_e2, boundary_lanes, target_intersections, emit_comments)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+            results = list(executor.map(_process_intersection, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        _init_worker(*init_args)
+        results = map(_process_intersection, tasks)
 
-        for i, phase in enumerate(phases):
-            state = phase.get('state')
-            has_relevant_green = False
-            
-            phase_detectors = {
-                "queue_detectors": [], # E2
-                "queue2_detector": []  # E1
-            }
-            
-            for link_idx, char in enumerate(state):
-                if char.lower() == 'g':
-                    if link_idx in tl_connections[tl_id]:
-                        lanes = tl_connections[tl_id][link_idx]
-                        for lane in lanes:
-                            # Check if this lane comes from a boundary node
-                            edge_id = get_edge_from_lane(lane)
-                            if edge_id in edges:
-                                from_node = edges[edge_id]['from']
-                                if from_node in boundary_nodes:
-                                    # Check if there are detectors on this lane
-                                    has_detectors_on_lane = (lane in lane_to_e2) or (lane in lane_to_e1)
-                                    if has_detectors_on_lane:
-                                        is_outer_intersection = True
-
-                            # Add E2 detectors
-                            if lane in lane_to_e2:
-                                for det in lane_to_e2[lane]:
-                                    if det not in phase_detectors["queue_detectors"]:
-                                        phase_detectors["queue_detectors"].append(det)
-                                        has_relevant_green = True
-                            
-                            # Add E1 detectors
-                            if lane in lane_to_e1:
-                                for det in lane_to_e1[lane]:
-                                    if det not in phase_detectors["queue2_detector"]:
-                                        phase_detectors["queue2_detector"].append(det)
-                                        has_relevant_green = True
-
-            if has_relevant_green:
-                green_phases.append(phase_detectors)
-
-        # Determine if we should include this intersection
-        should_include = False
-        if target_intersections is not None and len(target_intersections) > 0:
-            if tl_id in target_intersections:
-                should_include = True
-        else:
-            if is_outer_intersection:
-                should_include = True
-
-        # Only add this intersection if it meets criteria
-        if should_include and green_phases:
-            tl_data["phases"]["p"] = green_phases[0]
-            if len(green_phases) > 1:
-                tl_data["phases"]["s"] = []
-                for i in range(1, len(green_phases)):
-                    phase_obj = green_phases[i]
-                    phase_obj["comment"] = f"Secondary Phase {i}"
-                    tl_data["phases"]["s"].append(phase_obj)
-            else:
-                 tl_data["phases"]["s"] = []
-
-            solver_input_detectors[tl_id] = tl_data
+    solver_input_detectors = dict(result for result in results if result is not None)
 
     output_data = {
         "metadata": {
@@ -277,8 +320,7 @@ def generate_config(net_file, add_file, output_file, boundary_buffer, target_int
         }
     }
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2)
+    write_json(output_data, output_file)
     
     print(f"Successfully generated config at: {output_file}")
     print(f"Total intersections included: {len(solver_input_detectors)}")
@@ -290,11 +332,13 @@ if __name__ == "__main__":
     parser.add_argument("--output", default="detector_config_generated.json", help="Path to output json file")
     parser.add_argument("--boundary-buffer", type=float, default=50.0, help="Buffer distance from network boundary to consider a node as boundary node")
     parser.add_argument("--target-intersections", help="Comma separated list of intersection IDs to include. If provided, ignores boundary logic.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for per-intersection processing (1 = run serially)")
+    parser.add_argument("--emit-comments", action="store_true", help="Add a 'Secondary Phase i' comment to each secondary phase in the output")
     
     args = parser.parse_args()
     
     targets = None
     if args.target_intersections:
-        targets = args.target_intersections.split(',')
+        targets = frozenset(args.target_intersections.split(','))
     
-    generate_config(args.net_file, args.add_file, args.output, args.boundary_buffer, targets)
+    generate_config(args.net_file, args.add_file, args.output, args.boundary_buffer, targets, args.workers, args.emit_comments)
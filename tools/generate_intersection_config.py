@@ -1,8 +1,9 @@
 import os
-import json
-import xml.etree.ElementTree as ET
+from contextlib import closing
 import argparse
 
+from config_io import iter_elements, write_json
+
 """
 HƯỚNG DẪN SỬ DỤNG:
 Script này dùng để tạo file intersection_config.json từ thông tin mạng lưới SUMO (network).
@@ -30,49 +31,57 @@ Logic:
 def parse_network(net_file, target_ids):
     """
     Parse .net.xml to get traffic light logic and junction positions.
+    The file is streamed in a single pass that stops once every target junction has been found.
     """
-    tree = ET.parse(net_file)
-    root = tree.getroot()
+    target_ids = frozenset(target_ids)
     
     traffic_lights = {}
     intersections = {}
-    
-    # Parse Traffic Light Logics
-    for tl in root.findall('tlLogic'):
-        tl_id = tl.get('id')
-        if tl_id not in target_ids:
-            continue
-            
-        phases = []
-        total_cycle = 0
-        for phase in tl.findall('phase'):
-            state = phase.get('state')
-            duration = float(phase.get('duration'))
-            phases.append({'duration': duration, 'state': state})
-            total_cycle += duration
-            
-        traffic_lights[tl_id] = {
-            "type": tl.get('type', 'static'),
-            "phases": phases,
-            "total_cycle": int(total_cycle)
-        }
 
-    # Parse Junctions (Nodes) to get coordinates
-    # Note: In SUMO, a TL system might control multiple junctions or a single junction.
-    # Here we assume the TL ID corresponds to a Junction ID or we find the junction controlled by it.
-    # For simplicity, we look for junctions with id == tl_id first.
+    # Junction targets still to be found. A net.xml lists every tlLogic before the
+    # junction block, so once all target junctions are seen no tlLogic can follow
+    # and parsing stops.
+    remaining_junctions = set(target_ids)
     
-    # Create a mapping of TL ID to Junction ID(s) if needed, but often they match or we use the TL ID as key.
-    for junction in root.findall('junction'):
-        jid = junction.get('id')
-        if jid in target_ids:
-            intersections[jid] = {
-                "id": jid,
-                "traffic_light_id": jid,
-                "type": "traffic_light",
-                "x": float(junction.get('x')),
-                "y": float(junction.get('y'))
-            }
+    # closing(): the loop may stop early, so release the file explicitly
+    with closing(iter_elements(net_file, ('tlLogic', 'junction'))) as elements:
+        for elem in elements:
+            tag = elem.tag
+            elem_id = elem.get('id')
+            if elem_id not in target_ids:
+                continue
+
+            if tag == 'tlLogic':
+                # Parse Traffic Light Logics. Several programs may share an id; like
+                # SUMO, keep the last one.
+                phases = []
+                total_cycle = 0
+                for phase in elem.findall('phase'):
+                    state = phase.get('state')
+                    duration = float(phase.get('duration'))
+                    phases.append({'duration': duration, 'state': state})
+                    total_cycle += duration
+                
+                traffic_lights[elem_id] = {
+                    "type": elem.get('type', 'static'),
+                    "phases": phases,
+                    "total_cycle": int(total_cycle)
+                }
+            else:
+                # Parse Junctions (Nodes) to get coordinates
+                # Note: In SUMO, a TL system might control multiple junctions or a single junction.
+                # Here we assume the TL ID corresponds to a Junction ID or we find the junction controlled by it.
+                # For simplicity, we look for junctions with id == tl_id first.
+                intersections[elem_id] = {
+                    "id": elem_id,
+                    "traffic_light_id": elem_id,
+                    "type": "traffic_light",
+                    "x": float(elem.get('x')),
+                    "y": float(elem.get('y'))
+                }
+                remaining_junctions.discard(elem_id)
+                if not remaining_junctions:
+                    break
             
     return traffic_lights, intersections
 
@@ -104,7 +113,7 @@ def generate_config(net_file, output_file, target_intersections):
         
         for i, phase in enumerate(phases_list):
             # Heuristic: Green phase usually has 'G' or 'g' and duration > 5
-            if ('G' in phase['state'] or 'g' in phase['state']) and phase['duration'] > 5:
+            if 'g' in phase['state'].lower() and phase['duration'] > 5:
                 if p_phase is None:
                     p_phase = {
                         "phase_indices": [i],
@@ -158,8 +167,7 @@ def generate_config(net_file, output_file, target_intersections):
         }
     }
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(output_data, f, indent=2)
+    write_json(output_data, output_file)
     
     print(f"Successfully generated config at: {output_file}")
 